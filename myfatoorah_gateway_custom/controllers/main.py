@@ -5,12 +5,40 @@ import hmac
 import json
 import logging
 import pprint
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from odoo import http
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from odoo import SUPERUSER_ID, api, http
 from odoo.http import request
+from odoo.modules.registry import Registry
+from odoo.service.model import retrying
 
 _logger = logging.getLogger(__name__)
 
+# orjson is optional; its decode errors subclass ValueError like the stdlib ones.
+_json_loads = orjson.loads if orjson else json.loads
+
+# Webhook event types, with both their V2 and legacy names
+PAYMENT_STATUS_EVENTS = frozenset({'PAYMENT_STATUS_CHANGED', 'TransactionStatusChanged'})
+REFUND_STATUS_EVENTS = frozenset({'REFUND_STATUS_CHANGED', 'RefundStatusChanged'})
+BALANCE_TRANSFER_EVENTS = frozenset({'BALANCE_TRANSFERRED', 'BalanceTransferred'})
+
+# Verified webhook events are processed in the background so that the HTTP worker is
+# released as soon as the event is acknowledged. The queue only lives in the memory of the
+# worker: events still queued when it stops, is recycled or crashes are lost without trace.
+_WEBHOOK_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='myfatoorah_webhook')
+
+# Digests of the event bodies currently queued or being processed, to drop retries of these.
+_webhooks_in_progress = set()
+_webhooks_lock = threading.Lock()
+
 
 class MyFatoorahController(http.Controller):
     """Controller for MyFatoorah payment callbacks and webhooks."""
@@ -18,6 +46,12 @@ class MyFatoorahController(http.Controller):
     _return_url = '/payment/myfatoorah/return'
     _error_url = '/payment/myfatoorah/error'
     _webhook_url = '/payment/myfatoorah/webhook'
+    _webhook_max_body_size = 128 * 1024  # Bytes; MyFatoorah events are a few KB at most.
+    _webhook_event_handlers = {
+        **dict.fromkeys(PAYMENT_STATUS_EVENTS, '_handle_payment_status_event'),
+        **dict.fromkeys(REFUND_STATUS_EVENTS, '_handle_refund_status_event'),
+        **dict.fromkeys(BALANCE_TRANSFER_EVENTS, '_handle_balance_transfer_event'),
+    }
 
     # === PAYMENT RETURN HANDLERS === #
 
@@ -38,35 +72,7 @@ class MyFatoorahController(http.Controller):
         :param dict kwargs: The query string parameters from MyFatoorah redirect.
         :return: Redirect to the payment status page.
         """
-        _logger.info(
-            "MyFatoorah: Received success callback with data:\n%s",
-            pprint.pformat(kwargs),
-        )
-
-        payment_id = kwargs.get('paymentId')
-        if not payment_id:
-            _logger.error("MyFatoorah: No paymentId in success callback.")
-            return request.redirect('/payment/status')
-
-        # Build notification data
-        notification_data = {
-            'paymentId': payment_id,
-            'status': 'success',
-        }
-
-        # Find and process the transaction
-        try:
-            tx_sudo = request.env['payment.transaction'].sudo()._get_tx_from_notification_data(
-                'myfatoorah', notification_data
-            )
-            tx_sudo._handle_notification_data('myfatoorah', notification_data)
-        except Exception as e:
-            _logger.exception(
-                "MyFatoorah: Error processing success callback for paymentId %s: %s",
-                payment_id, str(e),
-            )
-
-        return request.redirect('/payment/status')
+        return self._process_redirect('success', kwargs)
 
     @http.route(
         _error_url,
@@ -82,20 +88,30 @@ class MyFatoorahController(http.Controller):
         :param dict kwargs: The query string parameters from MyFatoorah redirect.
         :return: Redirect to the payment status page.
         """
-        _logger.info(
-            "MyFatoorah: Received error callback with data:\n%s",
-            pprint.pformat(kwargs),
-        )
+        return self._process_redirect('error', kwargs)
+
+    def _process_redirect(self, status, data):
+        """Process the customer redirect from MyFatoorah and show the payment status.
+
+        :param str status: The redirect type, either 'success' or 'error'.
+        :param dict data: The query string parameters from MyFatoorah redirect.
+        :return: Redirect to the payment status page.
+        """
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info(
+                "MyFatoorah: Received %s callback with data:\n%s",
+                status, pprint.pformat(data),
+            )
 
-        payment_id = kwargs.get('paymentId')
+        payment_id = data.get('paymentId')
         if not payment_id:
-            _logger.error("MyFatoorah: No paymentId in error callback.")
+            _logger.error("MyFatoorah: No paymentId in %s callback.", status)
             return request.redirect('/payment/status')
 
         # Build notification data
         notification_data = {
             'paymentId': payment_id,
-            'status': 'error',
+            'status': status,
         }
 
         # Find and process the transaction
@@ -106,8 +122,8 @@ class MyFatoorahController(http.Controller):
             tx_sudo._handle_notification_data('myfatoorah', notification_data)
         except Exception as e:
             _logger.exception(
-                "MyFatoorah: Error processing error callback for paymentId %s: %s",
-                payment_id, str(e),
+                "MyFatoorah: Error processing %s callback for paymentId %s: %s",
+                status, payment_id, str(e),
             )
 
         return request.redirect('/payment/status')
@@ -133,14 +149,57 @@ class MyFatoorahController(http.Controller):
         - REFUND_STATUS_CHANGED
         - BALANCE_TRANSFERRED
 
-        :return: HTTP 200 on success, 400/401 on error.
+        Verified events are processed in the background; processing errors are
+        logged but do not change the response. Events are acknowledged before being
+        stored anywhere, so those still queued when the worker process stops or
+        crashes are lost, and MyFatoorah does not send them again. The payment
+        status is then only updated by the customer redirect, if any.
+
+        :return: HTTP 200 once accepted, 400/401/413/415 on error.
         """
         _logger.info("MyFatoorah: Received webhook event.")
 
-        # Read raw body for signature verification
+        # Reject implausible requests before reading and hashing their body
+        httprequest = request.httprequest
+        if (httprequest.content_length or 0) > self._webhook_max_body_size:
+            _logger.warning(
+                "MyFatoorah: Rejected webhook with oversized body (%s bytes).",
+                httprequest.content_length,
+            )
+            return request.make_json_response(
+                {'status': 'error', 'message': 'Request body too large'},
+                status=413,
+            )
+        if httprequest.mimetype != 'application/json':
+            _logger.warning(
+                "MyFatoorah: Rejected webhook with content type %s.", httprequest.mimetype,
+            )
+            return request.make_json_response(
+                {'status': 'error', 'message': 'Unsupported content type'},
+                status=415,
+            )
+
+        # Read raw body for signature verification. Chunked requests do not announce their
+        # length: lower the limit of the read to the webhook's, and check what was read in
+        # case the request stream was already created with Odoo's global limit.
+        max_body_size = self._webhook_max_body_size
+        httprequest.max_content_length = max_body_size
+        try:
+            raw_body = httprequest.get_data()
+        except RequestEntityTooLarge:
+            raw_body = None
+        if raw_body is None or len(raw_body) > max_body_size:
+            _logger.warning(
+                "MyFatoorah: Rejected webhook with oversized body (more than %s bytes).",
+                max_body_size,
+            )
+            return request.make_json_response(
+                {'status': 'error', 'message': 'Request body too large'},
+                status=413,
+            )
+
         try:
-            raw_body = request.httprequest.get_data()
-            event_data = json.loads(raw_body)
+            event_data = _json_loads(raw_body)
         except (ValueError, TypeError) as e:
             _logger.error("MyFatoorah: Invalid webhook JSON body: %s", str(e))
             return request.make_json_response(
@@ -148,26 +207,23 @@ class MyFatoorahController(http.Controller):
                 status=400,
             )
 
-        _logger.info(
-            "MyFatoorah: Webhook event data:\n%s",
-            pprint.pformat(event_data),
-        )
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info(
+                "MyFatoorah: Webhook event data:\n%s",
+                pprint.pformat(event_data),
+            )
 
         # Extract signature from headers
-        signature = request.httprequest.headers.get('MyFatoorah-Signature', '')
-        if not signature:
-            # Also check lowercase header
-            signature = request.httprequest.headers.get('myfatoorah-signature', '')
+        signature = httprequest.headers.get('MyFatoorah-Signature', '')  # Case-insensitive
 
         event_type = event_data.get('Event') or event_data.get('EventType', 'Unknown')
         _logger.info("MyFatoorah: Webhook event type: %s", event_type)
 
         # Find the appropriate provider for signature verification
-        providers = request.env['payment.provider'].sudo().search([
-            ('code', '=', 'myfatoorah'),
-            ('state', 'in', ['enabled', 'test']),
-            ('myfatoorah_webhook_enabled', '=', True),
-        ])
+        provider_model_sudo = request.env['payment.provider'].sudo()
+        providers = provider_model_sudo.browse(
+            provider_model_sudo._get_myfatoorah_webhook_provider_ids()
+        )
 
         if not providers:
             _logger.warning(
@@ -180,15 +236,9 @@ class MyFatoorahController(http.Controller):
             )
 
         # Verify signature with at least one provider
-        signature_verified = False
-        matching_provider = None
-        for provider in providers:
-            if provider._myfatoorah_verify_webhook_signature(raw_body, signature):
-                signature_verified = True
-                matching_provider = provider
-                break
-
-        if not signature_verified:
+        matching_provider = providers._myfatoorah_get_webhook_provider(raw_body, signature)
+
+        if not matching_provider:
             _logger.warning(
                 "MyFatoorah: Webhook signature verification failed for all providers."
             )
@@ -197,100 +247,173 @@ class MyFatoorahController(http.Controller):
                 status=401,
             )
 
-        # Process the webhook event based on type
+        # Drop retries of an event that is still being processed. Only byte-identical
+        # bodies are retries: other events of the same payment must all be processed.
+        event_key = (request.db, hashlib.sha256(raw_body).digest())
+        with _webhooks_lock:
+            if event_key in _webhooks_in_progress:
+                _logger.info(
+                    "MyFatoorah: Webhook event %s is already being processed. "
+                    "Ignoring retry.", event_type,
+                )
+                return request.make_json_response(
+                    {'status': 'ok', 'message': 'Event already being processed'},
+                    status=200,
+                )
+            _webhooks_in_progress.add(event_key)
+
+        # Process the webhook event in the background and acknowledge it right away
+        _WEBHOOK_POOL.submit(
+            self._process_webhook_event_in_background,
+            request.db, event_type, event_data, matching_provider.id, event_key,
+        )
+
+        return request.make_json_response(
+            {'status': 'ok', 'message': 'Event accepted'},
+            status=200,
+        )
+
+    def _process_webhook_event_in_background(
+        self, dbname, event_type, event_data, provider_id, event_key
+    ):
+        """Process a verified webhook event in a worker thread with its own cursor.
+
+        The processing is retried on concurrency errors, like Odoo does for the requests
+        it dispatches, as the customer redirect often updates the same transaction at
+        the same time. Other errors are logged only: the event was already acknowledged
+        to MyFatoorah, which must not retry it for errors on our side.
+
+        :param str dbname: The name of the database the event was received on.
+        :param str event_type: The type of webhook event.
+        :param dict event_data: The full webhook event payload.
+        :param int provider_id: The id of the matched provider.
+        :param tuple event_key: The key of the event in the in-progress set.
+        """
         try:
-            self._process_webhook_event(event_type, event_data, matching_provider)
+            with Registry(dbname).cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                provider_sudo = env['payment.provider'].sudo().browse(provider_id)
+                retrying(
+                    lambda: self._process_webhook_event(event_type, event_data, provider_sudo),
+                    env,
+                )
         except Exception as e:
             _logger.exception(
                 "MyFatoorah: Error processing webhook event %s: %s",
                 event_type, str(e),
             )
-            # Still return 200 to avoid MyFatoorah retries for processing errors
-            # The error is logged for debugging
-            return request.make_json_response(
-                {'status': 'ok', 'message': 'Event received but processing failed'},
-                status=200,
-            )
-
-        return request.make_json_response(
-            {'status': 'ok', 'message': 'Event processed successfully'},
-            status=200,
-        )
+        finally:
+            with _webhooks_lock:
+                _webhooks_in_progress.discard(event_key)
 
     def _process_webhook_event(self, event_type, event_data, provider):
-        """Process a verified webhook event.
+        """Process a verified webhook event by dispatching it to its handler.
 
         :param str event_type: The type of webhook event.
         :param dict event_data: The full webhook event payload.
-        :param payment.provider provider: The matched provider record.
+        :param payment.provider provider: The matched provider record, in sudo mode.
         """
         _logger.info(
             "MyFatoorah: Processing webhook event type: %s",
             event_type,
         )
 
-        # Extract relevant data from the event
         data = event_data.get('Data', event_data)
+        if not isinstance(data, dict):
+            _logger.warning(
+                "MyFatoorah: Ignoring webhook event %s with malformed data: %s",
+                event_type, data,
+            )
+            return
+        handler = getattr(
+            self, self._webhook_event_handlers.get(event_type, '_handle_unknown_event')
+        )
+        handler(event_type, data, provider)
+
+    def _handle_payment_status_event(self, event_type, data, provider):
+        """Update the transaction whose payment status changed.
+
+        :param str event_type: The type of webhook event.
+        :param dict data: The `Data` part of the webhook event payload.
+        :param payment.provider provider: The matched provider record, in sudo mode.
+        """
         invoice_id = data.get('InvoiceId')
-        payment_id = data.get('PaymentId')
-        customer_reference = data.get('CustomerReference')
-
-        if event_type in ('PAYMENT_STATUS_CHANGED', 'TransactionStatusChanged'):
-            # Build notification data for transaction processing
-            notification_data = {
-                'InvoiceId': invoice_id,
-                'paymentId': payment_id,
-                'CustomerReference': customer_reference,
-                'webhook_event': event_type,
-            }
-
-            try:
-                tx_sudo = request.env['payment.transaction'].sudo()._get_tx_from_notification_data(
-                    'myfatoorah', notification_data
-                )
-                tx_sudo._handle_notification_data('myfatoorah', notification_data)
-                _logger.info(
-                    "MyFatoorah: Webhook — Transaction %s updated for event %s.",
-                    tx_sudo.reference, event_type,
-                )
-            except Exception as e:
-                _logger.error(
-                    "MyFatoorah: Webhook — Failed to process PAYMENT_STATUS_CHANGED "
-                    "for InvoiceId %s: %s",
-                    invoice_id, str(e),
-                )
-                raise
 
-        elif event_type in ('REFUND_STATUS_CHANGED', 'RefundStatusChanged'):
-            refund_status = data.get('RefundStatus', '').lower()
+        # Build notification data for transaction processing
+        notification_data = {
+            'InvoiceId': invoice_id,
+            'paymentId': data.get('PaymentId'),
+            'CustomerReference': data.get('CustomerReference'),
+            'webhook_event': event_type,
+        }
+
+        try:
+            tx_sudo = provider.env['payment.transaction']._get_tx_from_notification_data(
+                'myfatoorah', notification_data
+            )
+            tx_sudo._handle_notification_data('myfatoorah', notification_data)
             _logger.info(
-                "MyFatoorah: Webhook — Refund status changed for InvoiceId %s: %s",
-                invoice_id, refund_status,
+                "MyFatoorah: Webhook — Transaction %s updated for event %s.",
+                tx_sudo.reference, event_type,
             )
-            # Find the transaction and log the refund status
-            if invoice_id:
-                tx_sudo = request.env['payment.transaction'].sudo().search([
-                    ('provider_reference', '=', str(invoice_id)),
-                    ('provider_code', '=', 'myfatoorah'),
-                ], limit=1)
-                if tx_sudo:
-                    tx_sudo.message_post(body=(
-                        f"MyFatoorah Webhook: Refund status changed to "
-                        f"'{refund_status}' for invoice {invoice_id}."
-                    ))
-                    _logger.info(
-                        "MyFatoorah: Refund status logged on transaction %s.",
-                        tx_sudo.reference,
-                    )
-
-        elif event_type in ('BALANCE_TRANSFERRED', 'BalanceTransferred'):
+        except Exception as e:
+            _logger.error(
+                "MyFatoorah: Webhook — Failed to process PAYMENT_STATUS_CHANGED "
+                "for InvoiceId %s: %s",
+                invoice_id, str(e),
+            )
+            raise
+
+    def _handle_refund_status_event(self, event_type, data, provider):
+        """Log the new refund status on the refunded transaction.
+
+        :param str event_type: The type of webhook event.
+        :param dict data: The `Data` part of the webhook event payload.
+        :param payment.provider provider: The matched provider record, in sudo mode.
+        """
+        invoice_id = data.get('InvoiceId')
+        refund_status = data.get('RefundStatus', '').lower()
+        _logger.info(
+            "MyFatoorah: Webhook — Refund status changed for InvoiceId %s: %s",
+            invoice_id, refund_status,
+        )
+        # Find the transaction and log the refund status
+        if invoice_id:
+            tx_sudo = provider.env['payment.transaction'].search([
+                ('provider_reference', '=', str(invoice_id)),
+                ('provider_code', '=', 'myfatoorah'),
+            ], limit=1)
+            if tx_sudo:
+                tx_sudo.message_post(body=(
+                    f"MyFatoorah Webhook: Refund status changed to "
+                    f"'{refund_status}' for invoice {invoice_id}."
+                ))
+                _logger.info(
+                    "MyFatoorah: Refund status logged on transaction %s.",
+                    tx_sudo.reference,
+                )
+
+    def _handle_balance_transfer_event(self, event_type, data, provider):
+        """Log the balance transfer. Informational — no transaction update needed.
+
+        :param str event_type: The type of webhook event.
+        :param dict data: The `Data` part of the webhook event payload.
+        :param payment.provider provider: The matched provider record, in sudo mode.
+        """
+        if _logger.isEnabledFor(logging.INFO):
             _logger.info(
                 "MyFatoorah: Webhook — Balance transferred event received. "
                 "Data: %s", pprint.pformat(data),
             )
-            # Informational — no transaction update needed
 
-        else:
+    def _handle_unknown_event(self, event_type, data, provider):
+        """Log an event type this module does not handle.
+
+        :param str event_type: The type of webhook event.
+        :param dict data: The `Data` part of the webhook event payload.
+        :param payment.provider provider: The matched provider record, in sudo mode.
+        """
+        if _logger.isEnabledFor(logging.INFO):
             _logger.info(
                 "MyFatoorah: Webhook — Unhandled event type: %s. Data: %s",
                 event_type, pprint.pformat(data),
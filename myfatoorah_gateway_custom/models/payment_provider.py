@@ -1,14 +1,24 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
-import hashlib
+import functools
 import hmac
+import http.cookiejar
 import logging
 import pprint
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import ValidationError
+from odoo.tools import frozendict
+
+from odoo.addons.myfatoorah_gateway_custom.controllers.main import (
+    MyFatoorahController,
+    _json_loads,
+)
 
 _logger = logging.getLogger(__name__)
 
@@ -37,9 +47,146 @@ MYFATOORAH_COUNTRY_SELECTION = [
     ('JO', 'Jordan'),
 ]
 
+# API base URL per provider state and country, test mode always using the sandbox
+MYFATOORAH_API_URLS = {
+    (state, country): MYFATOORAH_TEST_URL if state == 'test' else MYFATOORAH_LIVE_URLS[country]
+    for state in ('enabled', 'test', 'disabled')
+    for country, _label in MYFATOORAH_COUNTRY_SELECTION
+}
+
 # Timeout for API requests in seconds
 MYFATOORAH_TIMEOUT = 30
 
+# Shared HTTP session so that API calls reuse keep-alive connections instead of
+# opening a new TCP/TLS connection each time. Only idempotent methods are retried on
+# read errors; connection errors are retried for all methods as nothing was sent yet.
+# Cookies are never stored, since the session is shared by every provider and database.
+_SESSION = requests.Session()
+_SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False,
+    ),
+))
+
+# Digest of the webhook signatures
+MYFATOORAH_WEBHOOK_DIGEST = 'sha256'
+
+# Pool sending the same API request to several providers at once
+_REQUEST_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='myfatoorah_api')
+
+
+@functools.lru_cache(maxsize=32)
+def _get_hmac_prototype(secret):
+    """Return a keyed HMAC-SHA256 object that has not consumed any message yet.
+
+    The UTF-8 encoding and key schedule are only computed once per secret; callers must
+    `copy()` the prototype before feeding it a message.
+
+    :param str secret: The webhook secret key.
+    :return: The pre-keyed HMAC object.
+    :rtype: hmac.HMAC
+    """
+    return hmac.new(secret.encode('utf-8'), b'', MYFATOORAH_WEBHOOK_DIGEST)
+
+
+def _sign_webhook_body(secret, raw_body):
+    """Return the HMAC-SHA256 digest of a webhook body.
+
+    :param str secret: The webhook secret key.
+    :param bytes raw_body: The raw request body bytes.
+    :return: The raw digest.
+    :rtype: bytes
+    """
+    mac = _get_hmac_prototype(secret).copy()
+    mac.update(raw_body)
+    return mac.digest()
+
+
+class MyFatoorahRequestError(Exception):
+    """Failure of a request to the MyFatoorah API.
+
+    The error is not translated, as requests may be sent from threads without an
+    environment; see `payment.provider._myfatoorah_get_request_error_message`.
+
+    :param str code: The failure: 'timeout', 'connection', 'request', 'invalid_response'
+                     or 'api_error'.
+    :param str message: The error message returned by the API, for 'api_error'.
+    """
+
+    def __init__(self, code, message=None):
+        super().__init__(message or code)
+        self.code = code
+        self.message = message
+
+
+def _send_api_request(url, headers, payload=None, method='POST'):
+    """Send an HTTP request to the MyFatoorah API and return the response data.
+
+    This does not access the ORM so that it can run in worker threads.
+
+    :param str url: The full URL of the API endpoint.
+    :param dict headers: The request headers, including the authorization.
+    :param dict payload: The JSON request body.
+    :param str method: The HTTP method ('POST' or 'GET').
+    :return: The parsed JSON response data.
+    :rtype: dict
+    :raises MyFatoorahRequestError: If the request fails or returns an error.
+    """
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info(
+            "MyFatoorah API request: %s %s\nPayload:\n%s",
+            method, url,
+            pprint.pformat(payload) if payload else 'None',
+        )
+
+    try:
+        response = _SESSION.request(
+            method.upper(), url, json=payload, headers=headers, timeout=MYFATOORAH_TIMEOUT,
+        )
+    except requests.exceptions.Timeout:
+        _logger.error("MyFatoorah API request timed out: %s %s", method, url)
+        raise MyFatoorahRequestError('timeout')
+    except requests.exceptions.ConnectionError:
+        _logger.error("MyFatoorah API connection error: %s %s", method, url)
+        raise MyFatoorahRequestError('connection')
+    except requests.exceptions.RequestException as e:
+        _logger.error("MyFatoorah API request error: %s", str(e))
+        raise MyFatoorahRequestError('request')
+
+    # Parse the raw bytes directly rather than through `response.json()`, which
+    # first decodes the body to text, guessing its charset if none is declared.
+    try:
+        response_data = _json_loads(response.content)
+    except ValueError:
+        _logger.error(
+            "MyFatoorah API returned non-JSON response: %s (HTTP %s)",
+            response.content[:500].decode('utf-8', 'replace'), response.status_code,
+        )
+        raise MyFatoorahRequestError('invalid_response')
+
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info(
+            "MyFatoorah API response (HTTP %s):\n%s",
+            response.status_code,
+            pprint.pformat(response_data),
+        )
+
+    if response.status_code != 200 or not response_data.get('IsSuccess'):
+        error_message = response_data.get('Message', 'Unknown error')
+        validation_errors = response_data.get('ValidationErrors')
+        if validation_errors:
+            details = '; '.join([
+                err.get('Error', '') for err in validation_errors if isinstance(err, dict)
+            ])
+            error_message = f"{error_message} — {details}"
+        _logger.error("MyFatoorah API error: %s", error_message)
+        raise MyFatoorahRequestError('api_error', error_message)
+
+    return response_data.get('Data', {})
+
 
 class PaymentProvider(models.Model):
     _inherit = 'payment.provider'
@@ -91,6 +238,32 @@ class PaymentProvider(models.Model):
 
     # === CRUD METHODS === #
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        providers = super().create(vals_list)
+        if any(provider.code == 'myfatoorah' for provider in providers):
+            self.env.registry.clear_cache()
+        return providers
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {
+            'code', 'state', 'myfatoorah_webhook_enabled',
+            'myfatoorah_secret_key', 'myfatoorah_test_secret_key',
+        }.intersection(vals):
+            self.env.registry.clear_cache()
+        if 'myfatoorah_webhook_secret' in vals:
+            # Drop the key schedules of secrets that may no longer be in use.
+            _get_hmac_prototype.cache_clear()
+        return res
+
+    def unlink(self):
+        clear_cache = any(provider.code == 'myfatoorah' for provider in self)
+        res = super().unlink()
+        if clear_cache:
+            self.env.registry.clear_cache()
+        return res
+
     def _get_default_payment_method_codes(self):
         """ Override of `payment` to return the default payment method codes. """
         self.ensure_one()
@@ -100,6 +273,41 @@ class PaymentProvider(models.Model):
         # Odoo 19 typically treats this as 'card' or custom. 'card' is the standard for generic gateways.
         return {'card'}
 
+    # === BUSINESS METHODS === #
+
+    @api.model
+    @tools.ormcache()
+    def _get_myfatoorah_active_provider_ids(self):
+        """Return the ids of the enabled and test MyFatoorah providers.
+
+        The result is cached and invalidated whenever a provider is created, deleted or
+        has its code or state changed.
+
+        :return: The provider ids.
+        :rtype: tuple
+        """
+        return tuple(self.sudo().search([
+            ('code', '=', 'myfatoorah'),
+            ('state', 'in', ['enabled', 'test']),
+        ]).ids)
+
+    @api.model
+    @tools.ormcache()
+    def _get_myfatoorah_webhook_provider_ids(self):
+        """Return the ids of the active MyFatoorah providers accepting webhooks.
+
+        The result is cached and invalidated whenever a provider is created, deleted or
+        has its code, state or webhook flag changed.
+
+        :return: The provider ids.
+        :rtype: tuple
+        """
+        return tuple(self.sudo().search([
+            ('code', '=', 'myfatoorah'),
+            ('state', 'in', ['enabled', 'test']),
+            ('myfatoorah_webhook_enabled', '=', True),
+        ]).ids)
+
     # === API HELPERS === #
 
     def _myfatoorah_get_api_url(self):
@@ -109,10 +317,50 @@ class PaymentProvider(models.Model):
         :rtype: str
         """
         self.ensure_one()
-        if self.state == 'test':
-            return MYFATOORAH_TEST_URL
-        country = self.myfatoorah_country_code or 'SA'
-        return MYFATOORAH_LIVE_URLS.get(country, MYFATOORAH_LIVE_URLS['SA'])
+        return MYFATOORAH_API_URLS[self.state, self.myfatoorah_country_code or 'SA']
+
+    def _myfatoorah_get_request_error_message(self, error):
+        """Return the translated message of a failed API request.
+
+        :param MyFatoorahRequestError error: The error of the request.
+        :return: The error message.
+        :rtype: str
+        """
+        if error.code == 'timeout':
+            return _(
+                "MyFatoorah: The request to the payment gateway timed out. Please try again."
+            )
+        if error.code == 'connection':
+            return _(
+                "MyFatoorah: Could not connect to the payment gateway. "
+                "Please check your internet connection and try again."
+            )
+        if error.code == 'invalid_response':
+            return _("MyFatoorah: Received an invalid response from the payment gateway.")
+        if error.code == 'api_error':
+            return _("MyFatoorah: %(error)s", error=error.message)
+        return _(
+            "MyFatoorah: An error occurred while communicating with the payment gateway."
+        )
+
+    def _myfatoorah_get_callback_urls(self):
+        """Return the URLs MyFatoorah redirects the customer and sends webhooks to.
+
+        The base URL depends on the website of the current request, so the result is
+        computed on each call rather than stored on the provider.
+
+        :return: The return, error and webhook URLs.
+        :rtype: tuple
+        """
+        self.ensure_one()
+        # `get_base_url` returns an absolute URL and the paths are absolute: plain
+        # concatenation gives the same result as `url_join` without parsing the URL thrice.
+        base_url = self.get_base_url().rstrip('/')
+        return (
+            f'{base_url}{MyFatoorahController._return_url}',
+            f'{base_url}{MyFatoorahController._error_url}',
+            f'{base_url}{MyFatoorahController._webhook_url}',
+        )
 
     def _myfatoorah_get_api_key(self):
         """Return the correct API key based on provider state.
@@ -133,6 +381,22 @@ class PaymentProvider(models.Model):
             ))
         return key
 
+    @tools.ormcache('self.id', 'self.state')
+    def _myfatoorah_get_request_headers(self):
+        """Return the headers of the API requests, including the authorization.
+
+        The result is cached and invalidated whenever the secret keys are written.
+
+        :return: The request headers.
+        :rtype: frozendict
+        """
+        self.ensure_one()
+        return frozendict({
+            'Authorization': f'Bearer {self._myfatoorah_get_api_key()}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+        })
+
     def _myfatoorah_make_request(self, endpoint, payload=None, method='POST'):
         """Make an HTTP request to the MyFatoorah API.
 
@@ -145,80 +409,49 @@ class PaymentProvider(models.Model):
         """
         self.ensure_one()
 
-        api_url = self._myfatoorah_get_api_url()
-        api_key = self._myfatoorah_get_api_key()
-        url = f"{api_url}{endpoint}"
-
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-        }
-
-        _logger.info(
-            "MyFatoorah API request: %s %s\nPayload:\n%s",
-            method, url,
-            pprint.pformat(payload) if payload else 'None',
-        )
+        url = f"{self._myfatoorah_get_api_url()}{endpoint}"
+        headers = self._myfatoorah_get_request_headers()
 
         try:
-            if method.upper() == 'POST':
-                response = requests.post(
-                    url, json=payload, headers=headers, timeout=MYFATOORAH_TIMEOUT,
-                )
-            else:
-                response = requests.get(
-                    url, headers=headers, timeout=MYFATOORAH_TIMEOUT,
-                )
-        except requests.exceptions.Timeout:
-            _logger.error("MyFatoorah API request timed out: %s %s", method, url)
-            raise ValidationError(_(
-                "MyFatoorah: The request to the payment gateway timed out. Please try again."
-            ))
-        except requests.exceptions.ConnectionError:
-            _logger.error("MyFatoorah API connection error: %s %s", method, url)
-            raise ValidationError(_(
-                "MyFatoorah: Could not connect to the payment gateway. "
-                "Please check your internet connection and try again."
-            ))
-        except requests.exceptions.RequestException as e:
-            _logger.error("MyFatoorah API request error: %s", str(e))
-            raise ValidationError(_(
-                "MyFatoorah: An error occurred while communicating with the payment gateway."
-            ))
+            return _send_api_request(url, headers, payload=payload, method=method)
+        except MyFatoorahRequestError as e:
+            raise ValidationError(self._myfatoorah_get_request_error_message(e)) from e
 
-        try:
-            response_data = response.json()
-        except ValueError:
-            _logger.error(
-                "MyFatoorah API returned non-JSON response: %s (HTTP %s)",
-                response.text[:500], response.status_code,
-            )
-            raise ValidationError(_(
-                "MyFatoorah: Received an invalid response from the payment gateway."
-            ))
+    def _myfatoorah_make_concurrent_requests(self, endpoint, payload=None, method='POST'):
+        """Make the same HTTP request to the MyFatoorah API of each provider concurrently.
 
-        _logger.info(
-            "MyFatoorah API response (HTTP %s):\n%s",
-            response.status_code,
-            pprint.pformat(response_data),
-        )
+        The requests are sent from a thread pool; the ORM is only accessed from the calling
+        thread. Requests that are still queued when the generator is closed are cancelled.
 
-        if response.status_code != 200 or not response_data.get('IsSuccess'):
-            error_message = response_data.get('Message', 'Unknown error')
-            validation_errors = response_data.get('ValidationErrors')
-            if validation_errors:
-                details = '; '.join(
-                    err.get('Error', '') for err in validation_errors if isinstance(err, dict)
+        :param str endpoint: The API endpoint path (e.g. '/v2/GetPaymentStatus').
+        :param dict payload: The JSON request body.
+        :param str method: The HTTP method ('POST' or 'GET').
+        :return: A generator of (provider, future) pairs in the order the requests finish;
+                 the result of the future is the parsed JSON response data, or it raises the
+                 MyFatoorahRequestError of the failed request, or the ValidationError of a
+                 provider without API key.
+        :rtype: generator
+        """
+        futures = {}
+        for provider in self:
+            try:
+                url = f"{provider._myfatoorah_get_api_url()}{endpoint}"
+                headers = provider._myfatoorah_get_request_headers()
+            except ValidationError as e:
+                future = Future()
+                future.set_exception(e)
+            else:
+                future = _REQUEST_POOL.submit(
+                    _send_api_request, url, headers, payload=payload, method=method,
                 )
-                error_message = f"{error_message} — {details}"
-            _logger.error("MyFatoorah API error: %s", error_message)
-            raise ValidationError(_(
-                "MyFatoorah: %(error)s",
-                error=error_message,
-            ))
+            futures[future] = provider
 
-        return response_data.get('Data', {})
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future
+        finally:
+            for future in futures:
+                future.cancel()
 
     def _myfatoorah_verify_webhook_signature(self, raw_body, signature):
         """Verify the HMAC-SHA256 signature of a webhook event.
@@ -236,13 +469,13 @@ class PaymentProvider(models.Model):
             )
             return False
 
-        expected_signature = hmac.new(
-            key=self.myfatoorah_webhook_secret.encode('utf-8'),
-            msg=raw_body,
-            digestmod=hashlib.sha256,
-        ).hexdigest()
+        expected_digest = _sign_webhook_body(self.myfatoorah_webhook_secret, raw_body)
 
-        is_valid = hmac.compare_digest(expected_signature, signature)
+        # Compare the raw 32-byte digests rather than their hex representations
+        try:
+            is_valid = hmac.compare_digest(expected_digest, bytes.fromhex(signature))
+        except ValueError:  # The signature is not a valid hexadecimal string
+            is_valid = False
 
         if is_valid:
             _logger.info("MyFatoorah webhook: Signature verification PASSED.")
@@ -250,7 +483,28 @@ class PaymentProvider(models.Model):
             _logger.warning(
                 "MyFatoorah webhook: Signature verification FAILED. "
                 "Expected: %s..., Got: %s...",
-                expected_signature[:16], signature[:16] if signature else 'None',
+                expected_digest.hex()[:16], signature[:16] if signature else 'None',
             )
 
         return is_valid
+
+    def _myfatoorah_get_webhook_provider(self, raw_body, signature):
+        """Return the provider of the recordset whose webhook secret signed the body.
+
+        Providers sharing the same webhook secret are only verified once.
+
+        :param bytes raw_body: The raw request body bytes.
+        :param str signature: The signature from the header.
+        :return: The matching provider, or an empty recordset.
+        :rtype: payment.provider
+        """
+        # Only load what the verification needs instead of prefetching every column
+        self.fetch(['myfatoorah_webhook_secret', 'name'])
+        providers_by_secret = {}
+        for provider in self:
+            providers_by_secret.setdefault(provider.myfatoorah_webhook_secret, provider)
+
+        for provider in providers_by_secret.values():
+            if provider._myfatoorah_verify_webhook_signature(raw_body, signature):
+                return provider
+        return self.browse()
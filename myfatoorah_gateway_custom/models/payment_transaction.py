@@ -2,17 +2,44 @@
 
 import logging
 import pprint
+import re
 
-from odoo import _, api, models
+from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
-from odoo.tools.urls import urljoin as url_join
+from odoo.tools import SQL, float_round
 
 _logger = logging.getLogger(__name__)
 
+# Everything but the digits and the '+' sign is stripped from the customer mobile number
+PHONE_STRIP_PATTERN = re.compile(r'[^\d+]')
+
+# Id of the provider that last resolved a paymentId to a transaction, per database
+_last_resolving_provider_ids = {}
+
+# Lowercased MyFatoorah invoice and transaction statuses mapped to transaction states
+STATUS_MAPPING = {
+    'paid': 'done',
+    'succss': 'done',  # MyFatoorah's actual spelling of the transaction status
+    'success': 'done',
+    'pending': 'pending',
+    'initiated': 'pending',
+    'expired': 'canceled',
+    'canceled': 'canceled',
+    'failed': 'error',
+}
+
 
 class PaymentTransaction(models.Model):
     _inherit = 'payment.transaction'
 
+    # === INDEXED FIELDS === #
+    # MyFatoorah notifications are matched on the InvoiceId stored here, so make that
+    # lookup an index probe instead of a sequential scan of all transactions. The index is
+    # partial: transactions without provider reference are never looked up by it. Lookups
+    # by `reference` already use the index of its unique constraint, and `provider_code`
+    # is a non-stored related field that cannot be part of an index.
+    provider_reference = fields.Char(index='btree_not_null')
+
     # === ACTION METHODS === #
 
     def _get_specific_processing_values(self, processing_values):
@@ -32,44 +59,46 @@ class PaymentTransaction(models.Model):
             return res
 
         provider = self.provider_id
-        base_url = provider.get_base_url()
-
-        # Build callback URLs
-        return_url = url_join(base_url, '/payment/myfatoorah/return')
-        error_url = url_join(base_url, '/payment/myfatoorah/error')
-        webhook_url = url_join(base_url, '/payment/myfatoorah/webhook')
+        partner = self.partner_id
+        reference = self.reference
+        amount = round(self.amount, 3)
+        currency_name = self.currency_id.name if self.currency_id else 'SAR'
+        return_url, error_url, webhook_url = provider._myfatoorah_get_callback_urls()
 
         # Determine language
         lang = 'ar' if self.partner_lang and 'ar' in self.partner_lang else 'en'
 
-        # Build invoice items from sale order lines if available
-        invoice_items = []
-        if self.sale_order_ids:
-            for order in self.sale_order_ids:
-                for line in order.order_line:
-                    if line.product_id and line.price_unit > 0:
-                        invoice_items.append({
-                            'ItemName': line.product_id.name or line.name or 'Product',
-                            'Quantity': int(line.product_uom_qty) or 1,
-                            'UnitPrice': round(line.price_unit, 3),
-                        })
-        if not invoice_items:
-            invoice_items.append({
-                'ItemName': self.reference or 'Payment',
+        # Build invoice items from sale order lines if available, or from the transaction
+        order_lines = self.sale_order_ids and self.env['sale.order.line'].search_fetch([
+            ('order_id', 'in', self.sale_order_ids.ids),
+            ('product_id', '!=', False),
+            ('price_unit', '>', 0),
+        ], ['product_id', 'name', 'product_uom_qty', 'price_unit'])
+        if order_lines:
+            invoice_items = [{
+                'ItemName': line.product_id.name or line.name or 'Product',
+                'Quantity': max(1, int(float_round(
+                    line.product_uom_qty, precision_digits=0, rounding_method='HALF-UP',
+                ))),
+                'UnitPrice': round(line.price_unit, 3),
+            } for line in order_lines]
+        else:
+            invoice_items = [{
+                'ItemName': reference or 'Payment',
                 'Quantity': 1,
-                'UnitPrice': round(self.amount, 3),
-            })
+                'UnitPrice': amount,
+            }]
 
         # Build the SendPayment payload
         payload = {
-            'InvoiceValue': round(self.amount, 3),
-            'CustomerName': self.partner_name or self.partner_id.name or 'Customer',
+            'InvoiceValue': amount,
+            'CustomerName': self.partner_name or partner.name or 'Customer',
             'NotificationOption': 'LNK',
             'CallBackUrl': return_url,
             'ErrorUrl': error_url,
             'Language': lang,
-            'DisplayCurrencyIso': self.currency_id.name if self.currency_id else 'SAR',
-            'CustomerReference': self.reference,
+            'DisplayCurrencyIso': currency_name,
+            'CustomerReference': reference,
             'InvoiceItems': invoice_items,
         }
 
@@ -79,25 +108,24 @@ class PaymentTransaction(models.Model):
             payload['NotificationOption'] = 'ALL'
 
         if self.partner_phone:
-            phone = ''.join(c for c in self.partner_phone if c.isdigit() or c == '+')
+            phone = PHONE_STRIP_PATTERN.sub('', self.partner_phone)
             if phone:
                 payload['CustomerMobile'] = phone
                 if payload['NotificationOption'] == 'LNK':
                     payload['NotificationOption'] = 'SMS'
 
         # Add customer address if available
-        partner = self.partner_id
         if partner and partner.street:
             payload['CustomerAddress'] = {
                 'Block': '',
                 'Street': partner.street or '',
                 'HouseBuildingNo': '',
-                'Address': ', '.join(filter(None, [
-                    partner.street, partner.street2,
-                    partner.city,
-                    partner.state_id.name if partner.state_id else '',
-                    partner.zip,
-                ])),
+                'Address': ', '.join([
+                    part for part in (
+                        partner.street, partner.street2, partner.city,
+                        partner.state_id.name, partner.zip,
+                    ) if part
+                ]),
                 'AddressInstructions': '',
             }
 
@@ -107,7 +135,7 @@ class PaymentTransaction(models.Model):
 
         _logger.info(
             "MyFatoorah: Creating invoice for transaction %s (amount: %s %s)",
-            self.reference, self.amount, self.currency_id.name,
+            reference, amount, currency_name,
         )
 
         # Call SendPayment API
@@ -123,15 +151,21 @@ class PaymentTransaction(models.Model):
 
         _logger.info(
             "MyFatoorah: Invoice created — ID: %s, URL: %s, Reference: %s",
-            invoice_id, invoice_url, self.reference,
+            invoice_id, invoice_url, reference,
         )
 
-        # Store the invoice ID as provider_reference for later lookup
-        self.provider_reference = str(invoice_id) if invoice_id else ''
+        # Store the invoice ID as provider_reference for later lookup. The column is updated
+        # directly as nothing depends on it, sparing the whole `write` machinery at checkout.
+        self.flush_recordset(['provider_reference'])
+        self.env.cr.execute(SQL(
+            "UPDATE %s SET provider_reference = %s WHERE id = %s",
+            SQL.identifier(self._table), str(invoice_id) if invoice_id else None, self.id,
+        ))
+        self.invalidate_recordset(['provider_reference'])
 
         return {
             'api_url': invoice_url,
-            'reference': self.reference,
+            'reference': reference,
         }
 
     # === NOTIFICATION HANDLING === #
@@ -159,57 +193,40 @@ class PaymentTransaction(models.Model):
             reference, payment_id, invoice_id,
         )
 
-        # Try finding by reference first
+        # Try finding by reference or provider_reference (InvoiceId) in a single query,
+        # preferring the match on reference
+        lookup_domain = []
         if reference:
-            tx = self.search([
-                ('reference', '=', reference),
-                ('provider_code', '=', 'myfatoorah'),
-            ], limit=1)
-            if tx:
-                return tx
-
-        # Try finding by provider_reference (InvoiceId)
+            lookup_domain.append(('reference', '=', reference))
         if invoice_id:
-            tx = self.search([
-                ('provider_reference', '=', str(invoice_id)),
-                ('provider_code', '=', 'myfatoorah'),
-            ], limit=1)
+            lookup_domain.append(('provider_reference', '=', str(invoice_id)))
+        if lookup_domain:
+            txs = self.search_fetch(
+                ['|'] * (len(lookup_domain) - 1) + lookup_domain
+                + [('provider_code', '=', 'myfatoorah')],
+                ['reference'],
+            )
+            tx = txs.filtered(lambda t: t.reference == reference)[:1] or txs[:1]
             if tx:
                 return tx
 
         # If we have a paymentId, query MyFatoorah API for details
         if payment_id:
-            providers = self.env['payment.provider'].sudo().search([
-                ('code', '=', 'myfatoorah'),
-                ('state', 'in', ['enabled', 'test']),
-            ])
-            for provider in providers:
-                try:
-                    status_data = provider._myfatoorah_make_request(
-                        '/v2/GetPaymentStatus',
-                        {'Key': payment_id, 'KeyType': 'PaymentId'},
-                    )
-                    ref = status_data.get('CustomerReference')
-                    inv_id = status_data.get('InvoiceId')
-                    if ref:
-                        tx = self.search([
-                            ('reference', '=', ref),
-                            ('provider_code', '=', 'myfatoorah'),
-                        ], limit=1)
-                        if tx:
-                            return tx
-                    if inv_id:
-                        tx = self.search([
-                            ('provider_reference', '=', str(inv_id)),
-                            ('provider_code', '=', 'myfatoorah'),
-                        ], limit=1)
-                        if tx:
-                            return tx
-                except Exception as e:
-                    _logger.warning(
-                        "MyFatoorah: Error querying payment status for lookup: %s", str(e),
-                    )
-                    continue
+            provider_model_sudo = self.env['payment.provider'].sudo()
+            providers = provider_model_sudo.browse(
+                provider_model_sudo._get_myfatoorah_active_provider_ids()
+            )
+            # Query the provider that resolved the last paymentId alone first, as payments
+            # usually all go through the same account, then all the others at once.
+            preferred_provider = providers.filtered(
+                lambda p: p.id == _last_resolving_provider_ids.get(self.env.cr.dbname)
+            )
+            for candidates in (preferred_provider, providers - preferred_provider):
+                tx = self._myfatoorah_get_tx_from_payment_status(
+                    candidates, payment_id, notification_data
+                )
+                if tx:
+                    return tx
 
         raise ValidationError(_(
             "MyFatoorah: No transaction found matching the notification data "
@@ -217,6 +234,63 @@ class PaymentTransaction(models.Model):
             ref=reference, pid=payment_id, iid=invoice_id,
         ))
 
+    def _myfatoorah_get_tx_from_payment_status(self, providers, payment_id, notification_data):
+        """Find the transaction of a paymentId by querying its status from the providers.
+
+        The providers are queried concurrently and the first response matching a transaction
+        wins. The matching response is stored in the notification data to be reused, along
+        with the id of the provider that returned it, when that provider is the transaction's.
+
+        :param payment.provider providers: The providers to query.
+        :param str payment_id: The MyFatoorah paymentId.
+        :param dict notification_data: The notification data from callback/webhook.
+        :return: The matching transaction, if any.
+        :rtype: payment.transaction recordset
+        """
+        if not providers:
+            return self.browse()
+
+        responses = providers._myfatoorah_make_concurrent_requests(
+            '/v2/GetPaymentStatus', {'Key': payment_id, 'KeyType': 'PaymentId'},
+        )
+        try:
+            for provider, future in responses:
+                try:
+                    status_data = future.result()
+                except Exception as e:
+                    _logger.warning(
+                        "MyFatoorah: Error querying payment status for lookup: %s", str(e),
+                    )
+                    continue
+                ref = status_data.get('CustomerReference')
+                inv_id = status_data.get('InvoiceId')
+                tx = self.browse()
+                if ref:
+                    tx = self.search_fetch([
+                        ('reference', '=', ref),
+                        ('provider_code', '=', 'myfatoorah'),
+                    ], ['reference'], limit=1)
+                if not tx and inv_id:
+                    tx = self.search_fetch([
+                        ('provider_reference', '=', str(inv_id)),
+                        ('provider_code', '=', 'myfatoorah'),
+                    ], ['reference'], limit=1)
+                if tx:
+                    _last_resolving_provider_ids[self.env.cr.dbname] = provider.id
+                    # Remember what the API returned so that the lookup done again by
+                    # `_handle_notification_data` and the processing of the
+                    # notification do not query the same payment status again. The
+                    # status is only trusted if it comes from the transaction's own
+                    # provider, as another account may know an invoice with the same
+                    # reference.
+                    notification_data['CustomerReference'] = tx.reference
+                    if provider == tx.provider_id:
+                        notification_data['myfatoorah_status_data'] = (provider.id, status_data)
+                    return tx
+        finally:
+            responses.close()
+        return self.browse()
+
     def _process_notification_data(self, notification_data):
         """ Override of `payment` to process MyFatoorah notification data.
 
@@ -254,26 +328,33 @@ class PaymentTransaction(models.Model):
             ))
             return
 
-        # Call GetPaymentStatus
-        try:
-            status_data = self.provider_id._myfatoorah_make_request(
-                '/v2/GetPaymentStatus',
-                {'Key': str(key), 'KeyType': key_type},
+        # Call GetPaymentStatus, unless the transaction lookup already did it with the
+        # transaction's provider
+        status_data = None
+        stored_status = notification_data.get('myfatoorah_status_data')
+        if isinstance(stored_status, tuple) and stored_status[0] == self.provider_id.id:
+            status_data = stored_status[1]
+        if status_data is None:
+            try:
+                status_data = self.provider_id._myfatoorah_make_request(
+                    '/v2/GetPaymentStatus',
+                    {'Key': str(key), 'KeyType': key_type},
+                )
+            except ValidationError as e:
+                _logger.error(
+                    "MyFatoorah: Error getting payment status for tx %s: %s",
+                    self.reference, str(e),
+                )
+                self._set_error(_(
+                    "MyFatoorah: Failed to verify payment status."
+                ))
+                return
+
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(
+                "MyFatoorah: Payment status response for tx %s:\n%s",
+                self.reference, pprint.pformat(status_data),
             )
-        except ValidationError as e:
-            _logger.error(
-                "MyFatoorah: Error getting payment status for tx %s: %s",
-                self.reference, str(e),
-            )
-            self._set_error(_(
-                "MyFatoorah: Failed to verify payment status."
-            ))
-            return
-
-        _logger.info(
-            "MyFatoorah: Payment status response for tx %s:\n%s",
-            self.reference, pprint.pformat(status_data),
-        )
 
         # Extract status
         invoice_status = status_data.get('InvoiceStatus', '').lower()
@@ -296,17 +377,19 @@ class PaymentTransaction(models.Model):
             self.reference, invoice_status, tx_status,
         )
 
-        # Map MyFatoorah statuses to Odoo states
-        if invoice_status == 'paid' or tx_status == 'succss':
+        # Map MyFatoorah statuses to Odoo states; the invoice and its latest transaction are
+        # both considered, in the order done, pending, canceled, error.
+        states = {STATUS_MAPPING.get(invoice_status), STATUS_MAPPING.get(tx_status)}
+        if 'done' in states:
             self._set_done()
-        elif invoice_status in ('pending', 'initiated') or tx_status in ('pending', 'initiated'):
+        elif 'pending' in states:
             self._set_pending()
-        elif invoice_status in ('expired', 'canceled') or tx_status in ('expired', 'canceled'):
+        elif 'canceled' in states:
             self._set_canceled(state_message=_(
                 "MyFatoorah: Payment was %(status)s.",
                 status=invoice_status or tx_status,
             ))
-        elif invoice_status == 'failed' or tx_status == 'failed':
+        elif 'error' in states:
             error_msg = ''
             if latest_tx:
                 error_msg = latest_tx.get('Error', '') or latest_tx.get('ErrorCode', '')
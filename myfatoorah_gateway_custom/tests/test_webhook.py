@@ -0,0 +1,64 @@
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import hashlib
+import hmac
+import json
+from unittest.mock import patch
+
+from odoo.tests import HttpCase, tagged
+
+from odoo.addons.myfatoorah_gateway_custom.controllers.main import MyFatoorahController
+
+
+@tagged('post_install', '-at_install')
+class TestMyFatoorahWebhook(HttpCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.webhook_secret = 'dummy_webhook_secret'
+        cls.provider = cls.env.ref('payment.payment_provider_myfatoorah')
+        cls.provider.write({
+            'state': 'test',
+            'myfatoorah_test_secret_key': 'dummy_api_key',
+            'myfatoorah_webhook_secret': cls.webhook_secret,
+            'myfatoorah_webhook_enabled': True,
+        })
+
+    def _post_webhook(self, body, chunked=False):
+        """Post a webhook event signed with the provider's webhook secret.
+
+        :param bytes body: The raw request body.
+        :param bool chunked: Whether to send the body with chunked transfer encoding.
+        :return: The HTTP response.
+        :rtype: requests.Response
+        """
+        signature = hmac.new(self.webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+        data = iter([body[:len(body) // 2], body[len(body) // 2:]]) if chunked else body
+        return self.url_open(
+            MyFatoorahController._webhook_url,
+            data=data,
+            headers={
+                'Content-Type': 'application/json',
+                'MyFatoorah-Signature': signature,
+            },
+        )
+
+    def test_webhook_chunked_body_is_accepted(self):
+        body = json.dumps({'Event': 'BALANCE_TRANSFERRED', 'Data': {}}).encode()
+        with patch(
+            'odoo.addons.myfatoorah_gateway_custom.controllers.main._WEBHOOK_POOL'
+        ) as pool_mock:
+            response = self._post_webhook(body, chunked=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(pool_mock.submit.call_count, 1)
+
+    def test_webhook_oversized_body_is_rejected(self):
+        body = b'{"Data": "' + b'x' * MyFatoorahController._webhook_max_body_size + b'"}'
+        for chunked in (False, True):
+            with self.subTest(chunked=chunked), patch(
+                'odoo.addons.myfatoorah_gateway_custom.controllers.main._WEBHOOK_POOL'
+            ) as pool_mock:
+                response = self._post_webhook(body, chunked=chunked)
+                self.assertEqual(response.status_code, 413)
+                self.assertFalse(pool_mock.submit.called)